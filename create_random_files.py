@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import ctypes
+import errno
 import os
 import random
 import concurrent.futures
@@ -11,58 +13,109 @@ MIN_FILES = 1
 MAX_FILES = 1000
 MIN_SIZE = 1
 MAX_SIZE = 5 * 1024
+MAX_WORKERS = 16  # Concurrent file writers; storage queue depth saturates around 8-16
+FILES_PER_TASK = 32  # Files handed to a worker per round trip, amortizing IPC
+CHUNK_SIZE = 1 << 20  # Stream random data in 1 MiB blocks to bound memory use
 
-def create_single_file(filename):
-    if filename.exists():
-        print(f"Skipped: {filename} already exists.")
-        return 0  # Skip the file if it already exists
+# Raw fallocate(2) where libc exposes it. os.posix_fallocate falls back to
+# writing zeros on filesystems without native support, doubling the I/O.
+try:
+    _fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong)
+except (OSError, AttributeError):
+    _fallocate = None
+
+def _preallocate(fd, size):
+    if size == 0:
+        return
+    try:
+        if _fallocate is not None:
+            if _fallocate(fd, 0, 0, size) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+        elif hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        # Preallocation is only a hint; skip it where the filesystem lacks support
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS):
+            raise
+
+def create_single_file(filename, filesize_kb):
     try:
-        filesize_kb = random.randint(MIN_SIZE, MAX_SIZE)
-        with open(filename, 'wb') as f:
-            f.write(os.urandom(filesize_kb * 1024))
-        print(f"Created: {filename}")
+        size = filesize_kb * 1024
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            _preallocate(fd, size)
+            remaining = size
+            while remaining:
+                view = memoryview(random.randbytes(min(CHUNK_SIZE, remaining)))  # Test data, no CSPRNG needed
+                while view:
+                    written = os.write(fd, view)
+                    view = view[written:]
+                    remaining -= written
+        finally:
+            os.close(fd)
         return filesize_kb
+    except FileExistsError:
+        print(f"Skipped: {filename} already exists.")
+        return 0  # O_EXCL refuses to reuse an existing file, so skip it
     except OSError as e:
         print(f"Failed to create {filename}: {e}")  # Log the error for visibility
         return 0  # Return 0 if file creation fails due to OSError
 
-def create_random_files(directory):
+def plan_random_files(directory):
     num_files = random.randint(MIN_FILES, MAX_FILES)
     print(f"Creating {num_files} files in directory: {directory}")
-    total_size = 0
+    # Draw every size in one call and build plain path strings up front to keep
+    # per-file Python work out of the creation loop.
+    sizes = random.choices(range(MIN_SIZE, MAX_SIZE + 1), k=num_files)
+    prefix = f"{directory}/file_"
+    return [(f"{prefix}{i}.bin", size) for i, size in enumerate(sizes, 1)]
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-        futures = [executor.submit(create_single_file, directory / f"file_{i}.bin") for i in range(1, num_files + 1)]
-
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                total_size += future.result()
-            except Exception as e:
-                print(f"Failed to process a file: {e}")  # Handle any exception during file processing
+def create_dir(path):
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError as e:
+        print(f"Failed to create directory {path}: {e}")  # Handle directory creation errors
 
-    print(f"Finished creating files in directory: {directory}, Total size: {total_size // 1024} MiB")
-    return total_size
+def process_file(filename, filesize_kb):
+    try:
+        return create_single_file(filename, filesize_kb)
+    except Exception as e:
+        print(f"Failed to process a file: {e}")  # Handle any exception during file processing
+        return 0
 
-def create_directories_and_files(current_depth, current_dir):
+def plan_dirs(current_depth, current_dir):
+    dirs = [current_dir]
     if current_depth < MAX_DEPTH:
         num_subdirs = random.randint(1, 3)
-        subdirs = []
         for i in range(num_subdirs):
-            subdir = current_dir / f"dir_{current_depth}_{i}"
-            try:
-                subdir.mkdir(parents=True, exist_ok=True)
-            except Exception as e:
-                print(f"Failed to create directory {subdir}: {e}")  # Handle directory creation errors
-            subdirs.append(subdir)
+            dirs.extend(plan_dirs(current_depth + 1, current_dir / f"dir_{current_depth}_{i}"))
+    return dirs
+
+def create_directories_and_files(dirs):
+    # Directories are cheap, so the parent creates them all up front. Individual
+    # files are then the unit of work for a single pool spanning the whole tree,
+    # keeping every worker busy regardless of how files are spread across
+    # directories and with no per-level barriers.
+    files = []
+    for directory in dirs:
+        create_dir(directory)
+        files.extend((directory, filename, size) for filename, size in plan_random_files(directory))
 
-        for subdir in subdirs:
-            create_directories_and_files(current_depth + 1, subdir)
+    totals = {directory: [0, 0] for directory in dirs}  # directory -> [created, total KiB]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        sizes = executor.map(process_file, [f[1] for f in files], [f[2] for f in files], chunksize=FILES_PER_TASK)
+        for (directory, _, _), size in zip(files, sizes):
+            totals[directory][0] += size > 0
+            totals[directory][1] += size
 
-    create_random_files(current_dir)
+    for directory, (created, total_size) in totals.items():
+        print(f"Finished creating files in directory: {directory}, Created: {created} files, Total size: {total_size // 1024} MiB")
+    return sum(total_size for _, total_size in totals.values())
 
 if __name__ == "__main__":
     try:
-        BASE_DIR.mkdir(parents=True, exist_ok=True)
-        create_directories_and_files(1, BASE_DIR)
+        create_directories_and_files(plan_dirs(1, BASE_DIR))
     except Exception as e:
         print(f"Failed during execution: {e}")  # Handle any general exceptions
\ No newline at end of file
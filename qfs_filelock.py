@@ -30,24 +30,33 @@
 ################################################################################
 
 import argparse
+import atexit
+import calendar
 import configparser
-import daemon
+import fcntl
+import functools
 import getpass
-import inspect
 import json
 import logging
+import logging.handlers
+import concurrent.futures
 import os
+import queue
+import random
 import re
 import requests
 import signal
 import sys
+import threading
 import time
 import urllib3
 import warnings
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from urllib3.exceptions import InsecureRequestWarning
 from contextlib import redirect_stdout
 
+from qumulo.lib.request import RequestError
 from qumulo.rest_client import RestClient
 import qumulo.rest.fs as fs
 
@@ -56,34 +65,144 @@ signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 interval = None
 
+# Set on SIGTERM/SIGINT so that any wait in progress can end early
+_stop_event = threading.Event()
+
+# Set once main() returns and the lock pool is draining at exit
+_draining = False
+
+def handle_stop_signal(signum, frame):
+    # A second stop while the queued locks drain means "exit now"
+    if _draining and _stop_event.is_set():
+        abandon_pending_locks("Stop requested again while draining", 128 + signum)
+    _stop_event.set()
+    # Leave through SystemExit so pending locks and output are flushed at exit.
+    # While draining, only cut the --interval waits short; raising there would
+    # abort the drain and drop the queued locks.
+    if not _draining:
+        raise SystemExit(128 + signum)
+
+MULTI_SLASH = re.compile(r'/+')
+
+def collapse_slashes(path):
+    # Canonical paths are the common case; only run the regex when there is work to do
+    return MULTI_SLASH.sub('/', path) if '//' in path else path
+
+NOTIFICATION_TYPES_TO_HANDLE = frozenset({
+    "child_file_added",
+})
+
+# Notification types the API only raises for non-directory entries (directories
+# get the child_dir_* equivalents), so lock_file need not look the type up.
+NON_DIRECTORY_NOTIFICATION_TYPES = frozenset({
+    "child_file_added",
+    "child_file_moved_to",
+})
+
 ################################################################################
 # function load_config - Load configuration from a file
 ################################################################################
+_config_cache = {}
+
 def load_config(config_file_path):
     try:
+        # Parsed configs are cached by path and only re-read once the file's mtime changes
+        mtime = os.stat(config_file_path).st_mtime_ns
+        cached = _config_cache.get(config_file_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
         config = configparser.ConfigParser()
         config.read(config_file_path)
         if 'DEFAULT' not in config:
             raise ValueError(f"Configuration file {config_file_path} is missing the DEFAULT section.")
+        _config_cache[config_file_path] = (mtime, config)
         return config
     except Exception as e:
         logging.error(f"Failed to load configuration file: {config_file_path}")
-        logging.debug(f"Exception details: {e}")
+        logging.debug("Exception details: %s", e)
         raise
 
+################################################################################
+# function get_rest_client - Return the shared, logged-in RestClient
+################################################################################
+_RC_CACHE = None
+REST_TIMEOUT = 60  # Seconds; keeps a hung API call from blocking a worker (and exit) forever
+
+def get_rest_client(args, config=None):
+    global _RC_CACHE
+    if _RC_CACHE is None:
+        config = config or load_config(args.config_file)
+        rest_client = RestClient(config['DEFAULT']['API_HOST'], config['DEFAULT']['API_PORT'], timeout=REST_TIMEOUT)
+        rest_client.login(config['DEFAULT']['USERNAME'], config['DEFAULT']['PASSWORD'])
+        _RC_CACHE = rest_client
+    return _RC_CACHE
+
+def relogin(args, rest_client):
+    # Picks up credentials rewritten by --configure while the script is running
+    config = load_config(args.config_file)
+    rest_client.login(config['DEFAULT']['USERNAME'], config['DEFAULT']['PASSWORD'])
+    return rest_client
+
+def is_auth_error(error):
+    return isinstance(error, RequestError) and error.status_code in (401, 403)
+
+def is_not_found_error(error):
+    return isinstance(error, RequestError) and error.status_code == 404
+
 ################################################################################
 # function setup_logging - Set up logging configuration with optional file output
 ################################################################################
 def setup_logging(is_debug, log_file=None):  
+    global _log_listener
     log_level = logging.DEBUG if is_debug else logging.INFO
-    handlers = [logging.StreamHandler(sys.stdout)]
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    stream_handler = logging.StreamHandler(sys.stdout)
+    # write_output() records belong in the --output file only
+    stream_handler.addFilter(lambda record: record.name != output_logger.name)
+    handlers = [stream_handler]
     
     if log_file: 
         handlers.append(logging.FileHandler(log_file))
-    
-    logging.basicConfig(level=log_level, format='%(asctime)s - %(levelname)s - %(message)s', handlers=handlers)
+
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # Records are handed to a QueueListener thread so that callers (in particular
+    # the notification loop) never wait on terminal or disk I/O. Both loggers use
+    # the one queue, so the --output file keeps the order records were logged in.
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    output_logger.addHandler(queue_handler)
+
+    # force drops the stderr handler an earlier warning (e.g. from parse_args)
+    # installed. The listener's handlers add the timestamp and level.
+    logging.basicConfig(level=log_level, format='%(message)s', handlers=[queue_handler], force=True)
     logging.debug("Logging setup complete. Logging is now active.")
 
+_log_listener = None
+
+def start_log_listener():
+    if _log_listener is not None:
+        _log_listener.start()
+
+def stop_log_listener():
+    # Stopping drains whatever is still queued
+    if _log_listener is not None:
+        _log_listener.stop()
+
+################################################################################
+# function write_output - Append a message to the --output file only
+################################################################################
+output_logger = logging.getLogger('qfs_filelock.output')
+output_logger.propagate = False
+output_logger.setLevel(logging.INFO)
+
+def write_output(args, message, level=logging.INFO):
+    if args.output:
+        output_logger.log(level, message)
+
 ################################################################################
 # function parse_args - Parse command line arguments
 ################################################################################
@@ -113,28 +232,42 @@ def parse_args():
         return args
     except Exception as e:
         logging.error("Error parsing arguments.")
-        logging.debug(f"Exception details: {e}")
+        logging.debug("Exception details: %s", e)
         sys.exit(1)
 
+
+################################################################################
+# function display_header - Print the run settings banner
+################################################################################
+# The header layout is fixed, so the padding for every line is worked out once
+# here and display_header only fills in the values.
+HEADER_WIDTH = 65
+HEADER_BORDER = '#'
+HEADER_LABELS = {
+    "directory_path": "Directory:",
+    "file_num": "File Number:",
+    "interval": "Polling Interval:",
+    "recursive": "Recursive:",
+    "config_file": "Config File:",
+    "output": "Output File:",
+    "retention": "Retention Period:",
+    "legal_hold": "Legal Hold:",
+    "api_host": "API Host:",
+    "api_port": "API Port:",
+    "username": "Username:",
+}
+
+_max_label_length = max(len(label) for label in HEADER_LABELS.values())
+_HEADER_RULE = HEADER_BORDER * HEADER_WIDTH
+_HEADER_TITLE = f"{HEADER_BORDER}{'QFS File Lock Script'.center(HEADER_WIDTH - 2)}{HEADER_BORDER}"
+_HEADER_ROWS = tuple(
+    (attr, f'{HEADER_BORDER} {label}{" " * (_max_label_length - len(label) + 1)}{{:<{HEADER_WIDTH - _max_label_length - 4}}}{HEADER_BORDER}')
+    for attr, label in HEADER_LABELS.items()
+)
+
 def display_header(args, config, file_number=None, file_path=None):
     try:
         current_time_str = datetime.now().strftime("%Y-%m-%d %H:%M")
-        width = 65
-        border = '#'
-
-        attributes = {
-            "directory_path": "Directory:",
-            "file_num": "File Number:",
-            "interval": "Polling Interval:",
-            "recursive": "Recursive:",
-            "config_file": "Config File:",
-            "output": "Output File:",
-            "retention": "Retention Period:",
-            "legal_hold": "Legal Hold:",
-            "api_host": "API Host:",
-            "api_port": "API Port:",
-            "username": "Username:",
-        }
 
         values = {
             "directory_path": file_path or getattr(args, 'directory_path', None),
@@ -150,37 +283,40 @@ def display_header(args, config, file_number=None, file_path=None):
             "username": config['DEFAULT']['USERNAME'],
         }
 
-        max_label_length = max(len(label) for label in attributes.values())
-
         header = [
-            f"{border * width}",
-            f"{border}{'QFS File Lock Script'.center(width - 2)}{border}",
-            f"{border}{current_time_str.center(width - 2)}{border}",
-            f"{border * width}"
+            _HEADER_RULE,
+            _HEADER_TITLE,
+            f"{HEADER_BORDER}{current_time_str.center(HEADER_WIDTH - 2)}{HEADER_BORDER}",
+            _HEADER_RULE,
         ]
+        header.extend(row.format(str(values[attr])) for attr, row in _HEADER_ROWS if values[attr] is not None)
+        header.append(_HEADER_RULE)
 
-        for attr, label in attributes.items():
-            value = values[attr]
-            if value is not None:
-                header.append(f'{border} {label}{" " * (max_label_length - len(label) + 1)}{str(value).ljust(width - max_label_length - 4)}{border}')
-
-        header.append(f"{border * width}")
-
-        for line in header:
-            print(line, flush=True)
-            if args.output:
-                with open(args.output, 'a') as log_file:
-                    log_file.write(line + '\n')
+        header_text = '\n'.join(header) + '\n'
+        sys.stdout.write(header_text)
+        sys.stdout.flush()
+        if args.output:
+            with open(args.output, 'a') as log_file:
+                log_file.write(header_text)
     except Exception as e:
         logging.error("Failed to display header.")
-        logging.debug(f"Exception details: {e}")
+        logging.debug("Exception details: %s", e)
+
 
+################################################################################
+# function add_months - Calendar month arithmetic, clamping to the month's last day
+################################################################################
+def add_months(date, months):
+    month_index = date.month - 1 + months
+    year, month = date.year + month_index // 12, month_index % 12 + 1
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return date.replace(year=year, month=month, day=day)
 
 ################################################################################
 # function parse_retention - Parse the retention period
 ################################################################################
 def parse_retention(retention_period):
-    logging.debug(f"{inspect.currentframe().f_code.co_name} Retention argument is: {retention_period}.")
+    logging.debug("parse_retention Retention argument is: %s.", retention_period)
 
     if retention_period is None:
         logging.error("Retention is set to None, no retention period will be set.")
@@ -192,83 +328,215 @@ def parse_retention(retention_period):
             retention_date = datetime.utcnow() + timedelta(days=days)
         elif retention_period.endswith('m'):
             months = int(retention_period[:-1])
-            retention_date = datetime.utcnow() + timedelta(days=months * 30)
+            retention_date = add_months(datetime.utcnow(), months)
         elif retention_period.endswith('y'):
             years = int(retention_period[:-1])
-            retention_date = datetime.utcnow() + timedelta(days=years * 365)
+            retention_date = add_months(datetime.utcnow(), years * 12)
         else:
             retention_date = datetime.strptime(retention_period, "%Y-%m-%d")
         return retention_date.replace(microsecond=0).isoformat() + 'Z'
     except Exception as e:
         logging.error("Failed to parse retention period.")
-        logging.debug(f"Exception details: {e}")
+        logging.debug("Exception details: %s", e)
         return None
+
+################################################################################
+# function resolve_retention - Retention timestamp for a lock applied now
+################################################################################
+# A fixed date is parsed once. Relative periods (7d, 6m, 2y) count from the time
+# of the lock, so they are re-evaluated at most once a second; a burst of
+# notifications shares the result without a long run handing out expiries that
+# have already passed.
+@functools.lru_cache(maxsize=8)
+def _cached_retention(retention_period, second):
+    return parse_retention(retention_period)
+
+def resolve_retention(retention_period):
+    second = int(time.monotonic()) if retention_period[-1:] in ('d', 'm', 'y') else None
+    return _cached_retention(retention_period, second)
 ################################################################################
 # function lock_file - Lock a file using Qumulo API's modify_file_lock method
 ################################################################################
 
-recent_locks = {}
+# Paths locked within the cooldown, oldest first. Expired entries are pruned
+# and the size is capped so a long-running daemon does not grow without bound.
+# Times are time.monotonic() so clock adjustments cannot skew the cooldown.
+recent_locks = OrderedDict()
+LOCK_COOLDOWN = 5
+MAX_RECENT_LOCKS = 8192
+
+_recent_locks_lock = threading.Lock()
+
+def recently_locked(full_path, current_time, cooldown=LOCK_COOLDOWN):
+    with _recent_locks_lock:
+        locked_at = recent_locks.get(full_path)
+        return locked_at is not None and (current_time - locked_at) < cooldown
+
+def record_lock(full_path, current_time, cooldown=LOCK_COOLDOWN):
+    with _recent_locks_lock:
+        recent_locks[full_path] = current_time
+        recent_locks.move_to_end(full_path)
+        while recent_locks:
+            oldest_path, locked_at = next(iter(recent_locks.items()))
+            if len(recent_locks) <= MAX_RECENT_LOCKS and (current_time - locked_at) < cooldown:
+                break
+            del recent_locks[oldest_path]
+
+# Locks are applied from a bounded worker pool so that the --interval delay,
+# API latency and retries do not hold up reading the change notification
+# stream. Each worker keeps its own RestClient clone, since a RestClient wraps a
+# single HTTP connection. Once MAX_PENDING_LOCKS are queued new notifications
+# are dropped (and logged) rather than stalling the stream. On SIGTERM/SIGINT the
+# pool drains at exit and queued files are locked without waiting out --interval.
+LOCK_WORKERS = 16
+MAX_PENDING_LOCKS = 10000
+
+_LOCK_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=LOCK_WORKERS)
+_LOCK_SLOTS = threading.BoundedSemaphore(MAX_PENDING_LOCKS)
+_thread_state = threading.local()
+
+# Paths queued or being locked. A burst of notifications for the same file
+# (e.g. a tool rewriting it) collapses into the one lock already pending.
+_pending_locks = set()
+_pending_locks_lock = threading.Lock()
+
+def submit_lock_file(rest_client, args, full_path, file_number, debug, known_type=None):
+    full_path = collapse_slashes(full_path)
+    with _pending_locks_lock:
+        if full_path in _pending_locks or recently_locked(full_path, time.monotonic()):
+            logging.debug("Lock already pending or recently applied, not queueing: %s", full_path)
+            return
+        _pending_locks.add(full_path)
+
+    if not _LOCK_SLOTS.acquire(blocking=False):
+        logging.warning("Lock queue is full (%s pending), dropping notification for: %s", MAX_PENDING_LOCKS, full_path)
+        with _pending_locks_lock:
+            _pending_locks.discard(full_path)
+        return
+
+    not_before = time.monotonic() + (interval or 0)
+    try:
+        _LOCK_POOL.submit(lock_file_worker, rest_client, args, full_path, file_number, debug, known_type, not_before)
+    except Exception:
+        _LOCK_SLOTS.release()
+        with _pending_locks_lock:
+            _pending_locks.discard(full_path)
+        raise
 
-def lock_file(rest_client, args, full_path, file_number, debug, cooldown=5):
-    logging.debug(f"{inspect.currentframe().f_code.co_name}: Passed in: args is {args}, full_path is {full_path}, file_num is {file_number}")
+def lock_file_worker(rest_client, args, full_path, file_number, debug, known_type=None, not_before=0):
+    try:
+        delay = not_before - time.monotonic()
+        if delay > 0:
+            logging.debug("Delay of %.1f seconds before locking the file: %s", delay, full_path)
+        if delay > 0 and _stop_event.wait(delay):
+            # The file was seen before the stop, so lock it now rather than drop it
+            logging.debug("Stopping, skipping the rest of the --interval delay for: %s", full_path)
+        if getattr(_thread_state, 'rest_client', None) is None:
+            _thread_state.rest_client = rest_client.clone()
+        lock_file(_thread_state.rest_client, args, full_path, file_number, debug, known_type=known_type)
+    except Exception as e:
+        logging.error(f"lock_file: An error occurred in lock_file_worker: {str(e)}")
+    finally:
+        with _pending_locks_lock:
+            _pending_locks.discard(full_path)
+        _LOCK_SLOTS.release()
+
+# At exit the queued locks are given LOCK_DRAIN_TIMEOUT seconds (plus --interval
+# unless a stop cut the delays short). Whatever is left after that, or after a
+# second stop signal, is logged path by path so it can be locked by hand.
+LOCK_DRAIN_TIMEOUT = 30
+
+def drain_lock_pool():
+    with _pending_locks_lock:
+        pending = len(_pending_locks)
+    if not pending:
+        return
+    logging.info("Applying %s queued lock(s) before exit. Stop again to exit immediately.", pending)
+    timeout = LOCK_DRAIN_TIMEOUT if _stop_event.is_set() else LOCK_DRAIN_TIMEOUT + (interval or 0)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with _pending_locks_lock:
+            if not _pending_locks:
+                return
+        time.sleep(0.1)
+    abandon_pending_locks(f"Queued locks did not finish within {timeout} seconds", 1)
+
+def abandon_pending_locks(reason, exit_code):
+    with _pending_locks_lock:
+        pending = sorted(_pending_locks)
+    for path in pending:
+        logging.warning(f"{reason}, file was not locked: {path}")
+    _LOCK_POOL.shutdown(wait=False, cancel_futures=True)
+    stop_log_listener()
+    # Workers may be stuck in API calls, so skip the interpreter's thread joins
+    os._exit(exit_code)
+
+def lock_file(rest_client, args, full_path, file_number, debug, cooldown=LOCK_COOLDOWN, known_type=None):
+    logging.debug("lock_file: Passed in: args is %s, full_path is %s, file_num is %s", args, full_path, file_number)
 
     try:
         if not os.path.isabs(full_path):
             logging.error(f"Provided path is not absolute: {full_path}")
             return
 
-        full_path = re.sub(r'/+', '/', full_path)
+        full_path = collapse_slashes(full_path)
 
-        current_time = time.time()
-        if full_path in recent_locks and (current_time - recent_locks[full_path]) < cooldown:
-            logging.debug(f"Skipping recently locked file: {full_path}")
+        current_time = time.monotonic()
+        if recently_locked(full_path, current_time, cooldown):
+            logging.debug("Skipping recently locked file: %s", full_path)
             return
 
-        try:
-            logging.debug("Attempting to get file attributes...")
-            file_attr = fs.get_file_attr(rest_client.conninfo, rest_client.credentials, path=full_path)
-            logging.debug(f"File attributes: {file_attr}")
+        # A rejected session token is refreshed at most once per lock_file call
+        logged_in_again = False
 
-            if isinstance(file_attr, tuple):
-                file_attr = file_attr[0]
+        # The notification usually tells us the entry is not a directory; only
+        # ask the API when it did not.
+        if known_type is None:
+            try:
+                logging.debug("Attempting to get file attributes...")
+                file_attr = fs.get_file_attr(rest_client.conninfo, rest_client.credentials, path=full_path)
+                logging.debug("File attributes: %s", file_attr)
 
-            if not isinstance(file_attr, dict):
-                logging.error("Unexpected format for file attributes. Skipping.")
-                return
+                if isinstance(file_attr, tuple):
+                    file_attr = file_attr[0]
 
-        except Exception as e:
-            logging.debug("Failed to get file attributes. Reinitializing RestClient.")
-            config = load_config(args.config_file)
-            api_host = config['DEFAULT']['API_HOST']
-            api_port = config['DEFAULT']['API_PORT']
-            username = config['DEFAULT']['USERNAME']
-            password = config['DEFAULT']['PASSWORD']
+                if not isinstance(file_attr, dict):
+                    logging.error("Unexpected format for file attributes. Skipping.")
+                    return
 
-            rest_client = RestClient(api_host, api_port, timeout=120)
-            rest_client.login(username, password)
-            file_attr = fs.get_file_attr(rest_client.conninfo, rest_client.credentials, path=full_path)
+            except Exception as e:
+                if is_auth_error(e):
+                    logging.debug("Failed to get file attributes. Logging in again.")
+                    relogin(args, rest_client)
+                    logged_in_again = True
+                else:
+                    logging.debug("Failed to get file attributes: %s. Retrying.", e)
+                file_attr = fs.get_file_attr(rest_client.conninfo, rest_client.credentials, path=full_path)
 
-            if isinstance(file_attr, tuple):
-                file_attr = file_attr[0]
-            if not isinstance(file_attr, dict):
-                logging.error("Unexpected format for file attributes after reconnection. Skipping.")
-                return
+                if isinstance(file_attr, tuple):
+                    file_attr = file_attr[0]
+                if not isinstance(file_attr, dict):
+                    logging.error("Unexpected format for file attributes after reconnection. Skipping.")
+                    return
+            known_type = file_attr['type']
 
-        if file_attr['type'] == 'FS_FILE_TYPE_DIRECTORY':
+        if known_type == 'FS_FILE_TYPE_DIRECTORY':
             logging.info(f"Skipping directory: {full_path}")
             return
 
         retention_period = None
 
         if hasattr(args, 'retention') and args.retention:
-            retention_period = parse_retention(args.retention)
+            retention_period = resolve_retention(args.retention)
+            if retention_period is None:
+                logging.warning(f"Could not parse retention period {args.retention}. No retention period will be set for: {full_path}")
         else:
             logging.debug("Retention period not provided. No retention period will be set.")
 
         if not args.legal_hold and retention_period is None:
             logging.info("Neither legal hold nor a valid retention period was set. The lock will not be effective.")
 
-        logging.debug(f"Attempting to lock the file: {full_path} with {'legal hold' if args.legal_hold else ''} {'and retention period' if retention_period else ''}")
+        logging.debug("Attempting to lock the file: %s with %s %s", full_path, 'legal hold' if args.legal_hold else '', 'and retention period' if retention_period else '')
         max_retries = 3
         attempt = 0
 
@@ -283,25 +551,27 @@ def lock_file(rest_client, args, full_path, file_number, debug, cooldown=5):
                 )
                 success_message = f"Successfully locked file: {full_path}"
                 logging.info(success_message)
-                if args.output:
-                    with open(args.output, 'a') as log_file:
-                        log_file.write(f"{datetime.now()} - INFO - {success_message}")
-                logging.debug(f"Response: {response}")
+                logging.debug("Response: %s", response)
 
-                recent_locks[full_path] = current_time
+                record_lock(full_path, current_time, cooldown)
                 break
 
             except Exception as e:
                 attempt += 1
                 logging.error(f"Unexpected error when attempting to lock file: {full_path}. Error: {e}")
-                time.sleep(2)
+                if is_auth_error(e) and not logged_in_again:
+                    relogin(args, rest_client)
+                    logged_in_again = True
+                elif attempt < max_retries:
+                    # Exponential backoff with jitter so concurrent workers do not retry in lockstep
+                    time.sleep(min(0.1 * (2 ** attempt) + random.uniform(0, 0.1), 5.0))
 
         if attempt == max_retries:
             logging.error(f"Max retries reached. Failed to lock file: {full_path}")
 
     except Exception as e:
         logging.error(f"Error in lock_file function: {e}.")
-        logging.debug(f"Exception details: {e}")
+        logging.debug("Exception details: %s", e)
 
     finally:
         logging.debug("RestClient connection management completed.")
@@ -327,7 +597,7 @@ def configure_interactive(config_file):
         print(f"Configuration saved to {config_file}")
     except Exception as e:
         logging.error("Failed to configure interactive settings.")
-        logging.debug(f"Exception details: {e}")
+        logging.debug("Exception details: %s", e)
 
 ################################################################################
 # function get_fileinfo - Get file_num and fully qualified path
@@ -339,7 +609,7 @@ def get_fileinfo(rest_client, file_number=None, directory_path=None, debug=False
             if isinstance(response, tuple):
                 response = response[0]
             absolute_path = response['path']
-            logging.debug(f"file_num is {file_number} and absolute_path is {absolute_path}")
+            logging.debug("file_num is %s and absolute_path is %s", file_number, absolute_path)
 
         elif directory_path:
             response = fs.get_file_attr(rest_client.conninfo, rest_client.credentials, path=directory_path)
@@ -347,7 +617,7 @@ def get_fileinfo(rest_client, file_number=None, directory_path=None, debug=False
                 response = response[0]
             file_number = response['id']
             absolute_path = response['path']
-            logging.debug(f"file_num is {file_number} and absolute_path is {absolute_path}")
+            logging.debug("file_num is %s and absolute_path is %s", file_number, absolute_path)
         else:
             raise ValueError("Either file_num or directory_path must be provided")
 
@@ -355,57 +625,55 @@ def get_fileinfo(rest_client, file_number=None, directory_path=None, debug=False
 
     except ValueError as ve:
         logging.error("Invalid value provided for file Number or directory path.")
-        logging.debug(f"ValueError details: {ve}")
+        logging.debug("ValueError details: %s", ve)
         return "Error_ID", "Error_Path"
 
     except requests.exceptions.RequestException as re:
         logging.error("Request error occurred while retrieving file information.")
-        logging.debug(f"RequestException details: {re}")
+        logging.debug("RequestException details: %s", re)
         return "Error_ID", "Error_Path"
 
     except Exception as e:
         logging.error("Unexpected error occurred while retrieving file information.")
-        logging.debug(f"Exception details: {e}")
+        logging.debug("Exception details: %s", e)
         return "Error_ID", "Error_Path"
 
 ################################################################################
 # function stream_notifications - Stream notifications from Qumulo API
 ################################################################################
-def stream_notifications(rest_client, args, debug=False, output_file=None):
-    logging.debug(f"{inspect.currentframe().f_code.co_name}: Passed in: args is {args} and output_file is {output_file}")
+def stream_notifications(rest_client, args, debug=False, output_file=None, file_info=None):
+    logging.debug("stream_notifications: Passed in: args is %s and output_file is %s", args, output_file)
 
     try:
-        notification_types_to_handle = [
-            "child_file_added"
-        ]
-
-        if args.file_num:
-            file_number, file_path = get_fileinfo(rest_client, file_number=args.file_num, directory_path=args.directory_path, debug=debug)
-            path = None
-            id_ = file_number
-
-        elif args.directory_path:
-            file_number, file_path = get_fileinfo(rest_client, file_number=args.file_num, directory_path=args.directory_path, debug=debug)
-            path = file_path
-            id_ = None
-        else:
+        if not args.file_num and not args.directory_path:
             raise ValueError("Either file_num or directory_path must be provided")
 
-        logging.debug(f"{inspect.currentframe().f_code.co_name}: file_num is {file_number} and full_path is {path}")
+        # Callers that already resolved the watched path pass it in to save an API call
+        if file_info is None:
+            file_info = get_fileinfo(rest_client, file_number=args.file_num, directory_path=args.directory_path, debug=debug)
+        file_number, file_path = file_info
+        path = None if args.file_num else file_path
+        id_ = file_number if args.file_num else None
+
+        logging.debug("stream_notifications: file_num is %s and full_path is %s", file_number, path)
 
         changes_iterator = fs.get_change_notify_listener(
             conninfo=rest_client.conninfo,
             _credentials=rest_client.credentials,
             recursive=args.recursive,
-            type_filter=notification_types_to_handle,
+            type_filter=sorted(NOTIFICATION_TYPES_TO_HANDLE),
             path=path,
             id_=id_,
         ).data
 
         logging.info(f"Listening for change notifications on directory: {path} [file_num {file_number}] ")
 
+        file_path_prefix = str(file_path).rstrip('/') + '/'
+        # Only build the per-notification message when something will record it
+        log_notifications = bool(args.output) or logging.getLogger().isEnabledFor(logging.DEBUG)
+
         for change in changes_iterator:
-            logging.debug(f"Received change object: {change}")
+            logging.debug("Received change object: %s", change)
 
             if isinstance(change, list):
                 for change_dict in change:
@@ -413,81 +681,183 @@ def stream_notifications(rest_client, args, debug=False, output_file=None):
                     change_path = change_dict.get('path')
 
                     if change_type:
-                        logging.debug(f"Detected change of type: {change_type} at path: {change_path}")
-
-                    if change_type in notification_types_to_handle:
-                        new_file_abs_path = (str(file_path) + '/' + str(change_path)).replace('//', '/')
-                        notification_message = f"Received {change_type} notification for {new_file_abs_path} "
-                        logging.debug(notification_message)
-                        if args.output:
-                            with open(args.output, 'a') as log_file:
-                                log_file.write(f"{datetime.now()} - INFO - {notification_message}\n")
-                        try:
-                            if interval != 0:
-                                print(f"Delay of {interval} seconds before locking the file...", end='', flush=True)
-
-                        except BrokenPipeError:
-                            logging.warning("BrokenPipeError: Output stream was closed unexpectedly: {BrokenPipeError}.")
-                            break
-                        for _ in range(interval):
-                            time.sleep(1)
-                            try:
-                                print('.', end='', flush=True)
-                            except BrokenPipeError:
-                                logging.warning("BrokenPipeError: Output stream was closed unexpectedly: {BrokenPipeError}.")
-                                break
-                        try:
-                            lock_file(rest_client, args, new_file_abs_path, file_number, debug)
-                        except Exception as e:
-                            print(f"lock_file: An error occurred in {inspect.currentframe().f_code.co_name}: {str(e)}")
+                        logging.debug("Detected change of type: %s at path: %s", change_type, change_path)
+
+                    if change_type in NOTIFICATION_TYPES_TO_HANDLE:
+                        if not change_path:
+                            logging.warning(f"Ignoring {change_type} notification without a path: {change_dict}")
+                            continue
+                        new_file_abs_path = file_path_prefix + change_path.lstrip('/')
+                        if log_notifications:
+                            notification_message = f"Received {change_type} notification for {new_file_abs_path} "
+                            logging.debug(notification_message)
+                            write_output(args, notification_message)
+                        # The notify API has no file-type filter, so directories reported
+                        # under a handled type are dropped here before any REST call
+                        known_type = change_dict.get('file_type')
+                        if known_type is None and change_type in NON_DIRECTORY_NOTIFICATION_TYPES:
+                            known_type = 'FS_FILE_TYPE_FILE'
+                        elif known_type == 'FS_FILE_TYPE_DIRECTORY':
+                            logging.info(f"Skipping directory: {new_file_abs_path}")
+                            continue
+                        submit_lock_file(rest_client, args, new_file_abs_path, file_number, debug, known_type)
 
                         message = f"Waiting for notifications..."
 
                         if args.output:
-                            with open(args.output, 'a') as log_file:
-                                log_file.write(f"{datetime.now()} - INFO - {message}\n")
+                            write_output(args, message)
                         else:
                             logging.debug(message)
                     else:
-                        logging.debug(f"Ignored change of type: {change_type} at path: {change_path}")
+                        logging.debug("Ignored change of type: %s at path: %s", change_type, change_path)
             else:
                 logging.warning(f"Unexpected change format: {change}")
     except Exception as e:
         logging.error(f"Error occurred while streaming notifications: {e}")
-        if args.output:
-            with open(args.output, 'a') as log_file:
-                log_file.write(f"{datetime.now()} - ERROR - Error occurred while streaming notifications: {e}.\n")
-        logging.debug(f"Exception details: {e}")
+        logging.debug("Exception details: %s", e)
+        # Returned so run_daemon can tell a vanished watched path from a dropped stream
+        return e
+    finally:
+        # The notify stream occupies the client's keep-alive connection. Drop it so
+        # the next call on this client opens a fresh one instead of failing on the
+        # unfinished streaming response.
+        rest_client.refresh_connection()
+
+################################################################################
+# function daemonize - Detach from the terminal and write the pid file
+################################################################################
+DAEMON_STDOUT_LOG = '/var/log/qfs_filelock_daemon.log'
+DAEMON_STDERR_LOG = '/var/log/qfs_filelock_daemon_error.log'
+DAEMON_PIDFILE = '/var/run/qfs_filelock.pid'
+
+def open_fds():
+    try:
+        return [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except FileNotFoundError:
+        return range(os.sysconf('SC_OPEN_MAX'))
+
+def create_pidfile(pidfile):
+    try:
+        fd = os.open(pidfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        fd = os.open(pidfile, os.O_WRONLY)
+    # The lock is held across the forks and for the daemon's whole life, so a
+    # pid file nobody holds is stale whatever pid it contains
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        raise RuntimeError(f"Another instance is already running (pid file {pidfile})")
+    write_pid(fd)
+    return fd
+
+def write_pid(fd):
+    os.ftruncate(fd, 0)
+    os.pwrite(fd, f"{os.getpid()}\n".encode(), 0)
+
+def daemonize(preserve_fds=()):
+    # Open the logs and claim the pid file while still attached, so permission
+    # errors and a running instance are reported on the terminal
+    stdio_fds = [
+        os.open(os.devnull, os.O_RDONLY),
+        os.open(DAEMON_STDOUT_LOG, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644),
+        os.open(DAEMON_STDERR_LOG, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644),
+    ]
+    pid_fd = create_pidfile(DAEMON_PIDFILE)
+    # The listener threads would not survive the fork; flush and restart them
+    stop_log_listener()
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    try:
+        try:
+            first_fork = os.fork()
+        except OSError:
+            os.close(pid_fd)
+            os.remove(DAEMON_PIDFILE)
+            raise
+        if first_fork > 0:
+            os._exit(0)
+        os.setsid()
+        if os.fork() > 0:
+            os._exit(0)
+        os.chdir('/')
+        os.umask(0o002)
+
+        for target_fd, fd in enumerate(stdio_fds):
+            os.dup2(fd, target_fd)
+    finally:
+        start_log_listener()
+
+    # Close only descriptors that are actually open rather than every possible
+    # one up to RLIMIT_NOFILE
+    keep = {0, 1, 2, pid_fd, *preserve_fds}
+    for fd in open_fds():
+        if fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    write_pid(pid_fd)  # pid_fd stays open to keep the lock
 
 ################################################################################
 # function run_daemon - Function that runs as a daemon
 ################################################################################
-def run_daemon(rest_client, args):
+DAEMON_MAX_BACKOFF = 60
+
+def run_daemon(rest_client, args, config):
     try:
         logging.info("Daemon started, listening for changes...")
-        while True:
-            try:
-                if args.file_num or args.directory_path:
-                    file_number, full_path = get_fileinfo(rest_client, file_number=args.file_num, directory_path=args.directory_path, debug=args.debug)
-                    display_header(args, file_number, full_path)
-                    stream_notifications(rest_client, args, debug=args.debug, output_file=args.output)
+        if not args.file_num and not args.directory_path:
+            raise ValueError("Either file_num or directory_path must be provided")
+
+        # The notify listener pushes changes, so there is nothing to poll; only
+        # reconnect, backing off while the stream keeps dropping. The watched path
+        # is resolved once and again only if the API reports it gone.
+        file_info = None
+        backoff = 1
+        while not _stop_event.is_set():
+            started = time.monotonic()
+            if file_info is None:
+                file_info = get_fileinfo(rest_client, file_number=args.file_num, directory_path=args.directory_path, debug=args.debug)
+                if file_info[0] == "Error_ID":
+                    file_info = None
+                    logging.warning("Could not resolve the watched path. Retrying in %s seconds.", backoff)
                 else:
-                    logging.debug(f"{inspect.currentframe().f_code.co_name}: file_num is {file_number} and full_path is {full_path}")
-                    raise ValueError("Either file_num or directory_path must be provided")
-                time.sleep(args.interval)
-            except Exception as e:
-                logging.error("Daemon encountered an error.")
-                logging.debug(f"Exception details: {e}")
-                time.sleep(5)
+                    display_header(args, config, *file_info)
+
+            if file_info is not None:
+                try:
+                    error = stream_notifications(rest_client, args, debug=args.debug, output_file=args.output, file_info=file_info)
+                except Exception as e:
+                    logging.error("Daemon encountered an error.")
+                    logging.debug("Exception details: %s", e)
+                    error = e
+
+                if is_not_found_error(error):
+                    logging.warning("Watched path %s was not found, resolving it again.", file_info[1])
+                    file_info = None
+                if time.monotonic() - started > DAEMON_MAX_BACKOFF:
+                    backoff = 1  # The stream was healthy for a while; reconnect promptly
+                logging.warning("Change notification stream ended. Reconnecting in %s seconds.", backoff)
+
+            if _stop_event.wait(backoff):
+                break
+            backoff = min(backoff * 2, DAEMON_MAX_BACKOFF)
     except Exception as e:
         logging.error("Error occurred in daemon process.")
-        logging.debug(f"Exception details: {e}")
+        logging.debug("Exception details: %s", e)
 
 def main():
+    global interval, _draining
     try:
         args = parse_args()
-        global interval
         setup_logging(args.debug, log_file=args.output)
+        start_log_listener()
+        atexit.register(stop_log_listener)
+        signal.signal(signal.SIGTERM, handle_stop_signal)
+        signal.signal(signal.SIGINT, handle_stop_signal)
 
         if args.configure:
             configure_interactive(args.config_file)
@@ -502,41 +872,50 @@ def main():
             config = load_config(args.config_file)
             api_host = config['DEFAULT']['API_HOST']
             api_port = config['DEFAULT']['API_PORT']
-            username = config['DEFAULT']['USERNAME']
-            password = config['DEFAULT']['PASSWORD']
             interval = args.interval if args.interval is not None else 15
-            logging.debug(f"Configuration loaded. API Host: {api_host}, API Port: {api_port}")
+            logging.debug("Configuration loaded. API Host: %s, API Port: %s", api_host, api_port)
         except ValueError as ve:
             logging.error("Error loading configuration file.", exc_info=True)
             return
 
         try:
-            rc = RestClient(api_host, api_port)
-            rc.login(username, password)
+            rc = get_rest_client(args, config)
             logging.debug("Successfully logged in to Qumulo API")
         except Exception as e:
             logging.error("Failed to initialize RestClient or login.", exc_info=True)
             return
 
         if args.run_as_daemon:
-            with daemon.DaemonContext(
-                    stdout=open('/var/log/qfs_filelock_daemon.log', 'a+'),
-                    stderr=open('/var/log/qfs_filelock_daemon_error.log', 'a+'),
-                    working_directory='/',
-                    umask=0o002,
-                    pidfile=open('/var/run/qfs_filelock.pid', 'w+')):
-                run_daemon(rc, args)
+            # The daemon runs from '/', so resolve paths that are reopened later
+            args.config_file = os.path.abspath(args.config_file)
+            if args.output:
+                args.output = os.path.abspath(args.output)
+            log_fds = [h.stream.fileno() for h in _log_listener.handlers if isinstance(h, logging.FileHandler)]
+            # Drop the login connection; the daemon reconnects on its first request
+            rc.refresh_connection()
+            try:
+                daemonize(preserve_fds=log_fds)
+            except (OSError, RuntimeError) as e:
+                logging.error(f"Failed to start the daemon: {e}")
+                sys.exit(1)
+            try:
+                run_daemon(rc, args, config)
+            finally:
+                os.remove(DAEMON_PIDFILE)
         else:
             if args.file_num or args.directory_path:
                 file_number, full_path = get_fileinfo(rc, file_number=args.file_num, directory_path=args.directory_path, debug=args.debug)
                 display_header(args, config, file_number, full_path)
-                stream_notifications(rc, args, debug=args.debug, output_file=args.output)
+                stream_notifications(rc, args, debug=args.debug, output_file=args.output, file_info=(file_number, full_path))
             else:
-                logging.debug(f"{inspect.currentframe().f_code.co_name}: file_num is {file_number} and full_path is {full_path}")
+                logging.debug("main: file_num is %s and full_path is %s", file_number, full_path)
                 raise ValueError("Either file_num or directory_path must be provided")
     except Exception as e:
         logging.error("An error occurred in the main function.", exc_info=True)
-        logging.debug(f"Exception details: {e}")
+        logging.debug("Exception details: %s", e)
+    finally:
+        _draining = True
+        drain_lock_pool()
 
 if __name__ == '__main__':
     main()